@@ -4,20 +4,268 @@ A multi-agent system that transforms PDFs into interactive educational games
 """
 
 import streamlit as st
+import asyncio
+import hashlib
+import io
 import os
 import json
 import re
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
+import pymupdf
 import pymupdf4llm
-from jinja2 import Template
+import tiktoken
+import numpy as np
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+
+@st.cache_resource
+def _read_api_key() -> str | None:
+    """Read the OpenAI API key from .env once per process, not on every rerun"""
+    load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
+
+
+def load_api_key() -> str | None:
+    """Cached API key lookup that never caches a missing key"""
+    api_key = _read_api_key()
+    if not api_key:
+        # Look again on the next rerun so a key added to .env is picked up without a restart
+        _read_api_key.clear()
+    return api_key
+
 
 # Load environment variables
-load_dotenv()
+OPENAI_API_KEY = load_api_key()
+
+# Initialize OpenAI client (async so independent agent calls can overlap)
+client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+
+@st.cache_resource
+def get_encoding() -> tiktoken.Encoding:
+    """Tokenizer used to size document windows for Agent 1 (loaded on first use)"""
+    return tiktoken.encoding_for_model("gpt-4o")
+
+
+@st.cache_resource
+def get_pdf_executor() -> ThreadPoolExecutor:
+    """Process-wide worker pool for PDF parsing (MuPDF releases the GIL)"""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="pdf-extract")
+
+
+def link_or_move(src: Path, dest: Path):
+    """Place src at dest without copying data: hardlink, then rename, then copy"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        try:
+            os.rename(src, dest)
+        except OSError:
+            shutil.copy(src, dest)
+
+
+def pdf_to_markdown(pdf_bytes: bytes) -> str:
+    """Convert an in-memory PDF to Markdown without a temp file round-trip"""
+    doc = pymupdf.open(stream=pdf_bytes, filetype='pdf')
+    try:
+        return pymupdf4llm.to_markdown(doc)
+    finally:
+        doc.close()
+
+
+def write_atomic(path: Path, data: bytes):
+    """Write via a temp file and rename, so readers never see a partial file"""
+    path.parent.mkdir(exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+# Game types with a template in templates/
+GAME_TYPES = ['matching', 'quiz', 'flashcards']
+
+# Compiled Jinja2 template bytecode
+JINJA_CACHE_DIR = Path(".jinja_cache")
+
+# Agent 1 summaries, keyed by PDF content hash, survive across sessions here
+SUMMARY_CACHE_DIR = Path("cache")
+
+# Shared leading system message for agents 2-4 (keeps their prompt prefix identical)
+PIPELINE_PREAMBLE = """You are one agent in a multi-agent pipeline that turns documents into educational games.
+The content summary that follows is the single source of truth for every agent.
+Summary keys: t=topic, sa=subject area, kc=key concepts, f=facts, lo=learning objectives."""
+
+# Prompt-side compression of the summary (agents 2-4 never see the full version)
+SUMMARY_KEY_ALIASES = {
+    "topic": "t",
+    "subject_area": "sa",
+    "key_concepts": "kc",
+    "facts": "f",
+    "learning_objectives": "lo"
+}
+# Capital "A" stays: it is often part of a term (Vitamin A, Type A blood, A-level)
+FILLER_RE = re.compile(r'\b(?:[Tt]he|[Aa]n|a|[Tt]hat|[Ww]hich|[Vv]ery)\b')
+POLITE_RE = re.compile(r'\b(?:[Pp]lease|[Kk]indly|[Nn]ote that|[Ii]t is important to note that)\b')
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Structured Outputs schemas: the API guarantees responses that parse and match these
+STRING_LIST = {"type": "array", "items": {"type": "string"}}
+
+SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "topic": {"type": "string"},
+        "subject_area": {"type": "string"},
+        "key_concepts": STRING_LIST,
+        "facts": STRING_LIST,
+        "learning_objectives": STRING_LIST
+    },
+    "required": ["topic", "subject_area", "key_concepts", "facts", "learning_objectives"],
+    "additionalProperties": False
+}
+
+GAME_ITEM_SCHEMAS = {
+    "matching": ("pairs", {
+        "type": "object",
+        "properties": {
+            "term": {"type": "string"},
+            "definition": {"type": "string"}
+        },
+        "required": ["term", "definition"],
+        "additionalProperties": False
+    }),
+    "quiz": ("questions", {
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+            "options": STRING_LIST,
+            "correct": {"type": "integer"},
+            "explanation": {"type": "string"}
+        },
+        "required": ["question", "options", "correct", "explanation"],
+        "additionalProperties": False
+    }),
+    "flashcards": ("cards", {
+        "type": "object",
+        "properties": {
+            "front": {"type": "string"},
+            "back": {"type": "string"}
+        },
+        "required": ["front", "back"],
+        "additionalProperties": False
+    })
+}
+
+GAME_SCHEMAS = {
+    game_type: {
+        "type": "object",
+        "properties": {
+            "game_type": {"type": "string", "enum": [game_type]},
+            "title": {"type": "string"},
+            "theme_color": {"type": "string"},
+            items_key: {"type": "array", "items": item_schema}
+        },
+        "required": ["game_type", "title", "theme_color", items_key],
+        "additionalProperties": False
+    }
+    for game_type, (items_key, item_schema) in GAME_ITEM_SCHEMAS.items()
+}
+
+# Reviewer verdicts are a fixed issue code plus a few offending terms, never free text
+ISSUE_GUIDANCE = {
+    "ok": "Content approved",
+    "missing_concepts": "Some key concepts from the summary are missing; add items that cover them.",
+    "wrong_definition": "Some items are factually wrong; correct them to match the summary.",
+    "duplicates": "Some items repeat each other; replace duplicates with different concepts.",
+    "too_few_items": "The game has too few items; add more until it meets the minimum count."
+}
+
+REVIEW_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "approved": {"type": "boolean"},
+        "issue_code": {"type": "string", "enum": list(ISSUE_GUIDANCE)},
+        "bad_terms": {"type": "array", "items": {"type": "string"}, "maxItems": 3}
+    },
+    "required": ["approved", "issue_code", "bad_terms"],
+    "additionalProperties": False
+}
+
+# Local review: minimum item counts and the field that must match a source concept
+MIN_ITEMS = {"matching": 8, "quiz": 10, "flashcards": 12}
+TERM_FIELDS = {"matching": "term", "flashcards": "front"}
+ITEM_LABEL_FIELDS = {"matching": "term", "quiz": "question", "flashcards": "front"}
+
+# Concept embeddings: a term counts as backed by the source above this cosine similarity
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_MATCH_THRESHOLD = 0.6
+# Shorter labels only match a reviewer term exactly or by containing it
+MIN_LABEL_MATCH_LEN = 4
+
+# Game formats shared by the single and batched architect calls
+ARCHITECT_INSTRUCTIONS = """You are a game design architect specializing in educational games.
+
+Design games with the following structure:
+
+For MATCHING game:
+{
+  "game_type": "matching",
+  "title": "creative title",
+  "theme_color": "CSS color based on subject (e.g., medical=#00bfa5, history=#ff6b35, tech=#667eea)",
+  "pairs": [
+    {"term": "concept name", "definition": "clear definition"},
+    ... (minimum 8 pairs)
+  ]
+}
+
+For QUIZ game:
+{
+  "game_type": "quiz",
+  "title": "creative title",
+  "theme_color": "CSS color",
+  "questions": [
+    {
+      "question": "question text",
+      "options": ["A", "B", "C", "D"],
+      "correct": 0,
+      "explanation": "why this is correct"
+    },
+    ... (minimum 10 questions)
+  ]
+}
+
+For FLASHCARDS game:
+{
+  "game_type": "flashcards",
+  "title": "creative title",
+  "theme_color": "CSS color",
+  "cards": [
+    {"front": "term or question", "back": "definition or answer"},
+    ... (minimum 12 cards)
+  ]
+}
+
+Use content from the summary. Make it educational and engaging.
+Return ONLY valid JSON."""
+
+
+def json_schema_format(name: str, schema: dict) -> dict:
+    """Build a strict response_format for chat.completions.create"""
+    return {
+        "type": "json_schema",
+        "json_schema": {"name": name, "strict": True, "schema": schema}
+    }
 
-# Initialize OpenAI client
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Page config
 st.set_page_config(
@@ -27,8 +275,9 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+
 # Custom CSS for dark theme vibe
-st.markdown("""
+CSS_BLOB = """
 <style>
     /* Main app styling */
     .stApp {
@@ -91,18 +340,59 @@ st.markdown("""
         box-shadow: 0 10px 30px rgba(102, 126, 234, 0.3);
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+FOOTER_HTML = """
+<div style='text-align: center; color: #00f5ff; font-family: monospace;'>
+    Built with 🧠 AI Agents | Powered by GPT-4o & Streamlit
+</div>
+"""
+
+
+@st.cache_resource
+def inject_css():
+    """Inject the app stylesheet (cached; Streamlit replays it on reruns)"""
+    st.markdown(CSS_BLOB, unsafe_allow_html=True)
+
+
+@st.cache_resource
+def render_footer():
+    """Render the static footer (cached; Streamlit replays it on reruns)"""
+    st.markdown(FOOTER_HTML, unsafe_allow_html=True)
 
 
 class PDFGameFactory:
     """Multi-agent system to convert PDFs into interactive games"""
     
-    def __init__(self):
-        self.model = "gpt-4o"
+    def __init__(self, aggressive_cost_mode: bool = False):
+        self.set_cost_mode(aggressive_cost_mode)
         self.max_retries = 3
+        # Agent 1 reads the document in windows of this many tokens
+        self.window_tokens = 6000
+        # Long documents: at most this many window summaries in flight (avoids 429s)
+        self.max_concurrent_windows = 4
+        # Prompt cache bookkeeping (reset per workflow)
+        self._summary_cache_key = None
+        # Per-PDF state: content hash and L2-normalized key concept embeddings
+        self._pdf_digest = None
+        self._concepts_emb = None
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
         # Initialize template directory
         self._setup_templates()
         
+    def set_cost_mode(self, aggressive_cost_mode: bool):
+        """Pick the model per agent role: mini where the task is summarization or a yes/no check"""
+        self.models = {
+            "extractor": "gpt-4o-mini",
+            "architect": "gpt-4o",
+            "reviewer": "gpt-4o-mini",
+            "refiner": "gpt-4o",
+            "builder": None  # template rendering, no model call
+        }
+        if aggressive_cost_mode:
+            self.models = {role: "gpt-4o-mini" if model else None for role, model in self.models.items()}
+        
     def _setup_templates(self):
         """Ensure templates directory exists and locate template files"""
         self.template_dir = Path('templates')
@@ -115,30 +405,99 @@ class PDFGameFactory:
                 st.info("📁 Templates found in current directory. Creating templates/ folder...")
                 self.template_dir.mkdir(exist_ok=True)
                 # Move templates to proper directory
-                for game_type in ['matching', 'quiz', 'flashcards']:
+                for game_type in GAME_TYPES:
                     src = current_dir / f'{game_type}_game.html'
                     if src.exists():
-                        import shutil
-                        shutil.copy(src, self.template_dir / f'{game_type}_game.html')
+                        link_or_move(src, self.template_dir / f'{game_type}_game.html')
             else:
                 # Create empty templates directory
                 self.template_dir.mkdir(exist_ok=True)
                 st.warning(f"⚠️ Templates directory created at {self.template_dir.absolute()}")
                 st.info("Please add the template HTML files to the templates/ directory")
         
-    def agent_1_extractor(self, pdf_path: str) -> dict:
+        # Compile templates once; bytecode is also cached on disk across processes
+        JINJA_CACHE_DIR.mkdir(exist_ok=True)
+        self.env = Environment(
+            loader=FileSystemLoader(self.template_dir),
+            bytecode_cache=FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+            auto_reload=False
+        )
+        self.templates = {
+            game_type: self.env.get_template(f'{game_type}_game.html')
+            for game_type in GAME_TYPES
+            if (self.template_dir / f'{game_type}_game.html').exists()
+        }
+        
+    async def agent_1_extractor(self, pdf_bytes: bytes, status) -> dict:
         """AI Agent 1: Extract PDF content and create Markdown summary"""
-        st.markdown('<div class="agent-status">🤖 Agent 1 (Extractor): Processing PDF...</div>', 
-                   unsafe_allow_html=True)
+        status.markdown('<div class="agent-status">🤖 Agent 1 (Extractor): Processing PDF...</div>', 
+                       unsafe_allow_html=True)
         
         try:
-            # Extract markdown from PDF
-            markdown_text = pymupdf4llm.to_markdown(pdf_path)
+            # Extract markdown from PDF (normally already started in the background at upload time)
+            future = st.session_state.get("markdown_future")
+            if future is None:
+                future = get_pdf_executor().submit(pdf_to_markdown, pdf_bytes)
+            markdown_text = await asyncio.wrap_future(future)
         except Exception as e:
             st.error(f"Failed to extract PDF content: {str(e)}")
             raise
         
-        # Use AI to create a concise summary
+        # Token-accurate windowing: one call for short documents, map-reduce for long ones
+        encoding = get_encoding()
+        tokens = encoding.encode(markdown_text, disallowed_special=())
+        if len(tokens) <= self.window_tokens:
+            summary_json = await self._summarize_window(markdown_text)
+        else:
+            windows = [
+                encoding.decode(tokens[start:start + self.window_tokens])
+                for start in range(0, len(tokens), self.window_tokens)
+            ]
+            st.info(f"📚 Long document: summarizing {len(windows)} sections in parallel...")
+            semaphore = asyncio.Semaphore(self.max_concurrent_windows)
+            
+            async def summarize_bounded(window: str) -> dict:
+                async with semaphore:
+                    return await self._summarize_window(window)
+            
+            partials = [p for p in await asyncio.gather(*(summarize_bounded(w) for w in windows)) if p]
+            summary_json = await self._merge_summaries(partials) if partials else {}
+        
+        if not summary_json:
+            return {}
+        
+        summary_json['full_markdown'] = markdown_text
+        
+        return summary_json
+    
+    async def extract_and_summarize(self, pdf_bytes: bytes, status) -> dict:
+        """Agent 1 behind an on-disk cache keyed by the PDF's content hash"""
+        digest = hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+        self._pdf_digest = digest
+        cache_path = SUMMARY_CACHE_DIR / f"{digest}.json"
+        
+        if cache_path.exists():
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    summary = json.load(f)
+            except (OSError, ValueError):
+                # Unreadable entry: treat as a miss and overwrite it below
+                summary = None
+            if summary:
+                status.markdown('<div class="agent-status">♻️ Agent 1 (Extractor): Reusing cached summary for this PDF</div>', 
+                                unsafe_allow_html=True)
+                return summary
+        
+        summary = await self.agent_1_extractor(pdf_bytes, status)
+        if not summary:
+            return summary
+        
+        write_atomic(cache_path, json.dumps(summary).encode('utf-8'))
+        
+        return summary
+    
+    async def _summarize_window(self, content: str) -> dict:
+        """Summarize one token window of the document"""
         prompt = f"""You are an expert content analyzer. 
         
 Given this document content, create a comprehensive summary that captures:
@@ -148,7 +507,7 @@ Given this document content, create a comprehensive summary that captures:
 4. Learning objectives
 
 Document content:
-{markdown_text[:8000]}
+{content}
 
 Provide a structured summary in JSON format with these keys:
 - topic: main subject
@@ -159,154 +518,204 @@ Provide a structured summary in JSON format with these keys:
 
 Return ONLY valid JSON, no markdown formatting."""
 
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
+        return await self._chat(
+            "extractor",
+            [{"role": "user", "content": prompt}],
+            temperature=0.3,
+            response_format=json_schema_format("Summary", SUMMARY_SCHEMA)
         )
-        
-        summary_json = self._extract_json(response.choices[0].message.content)
-        summary_json['full_markdown'] = markdown_text
-        
-        return summary_json
     
-    def agent_2_architect(self, summary: dict, game_type: str) -> dict:
-        """AI Agent 2: Design game logic structure"""
-        st.markdown('<div class="agent-status">🏗️ Agent 2 (Architect): Designing game structure...</div>', 
-                   unsafe_allow_html=True)
-        
-        prompt = f"""You are a game design architect specializing in educational games.
-
-Content Summary:
-{json.dumps(summary, indent=2)}
+    async def _merge_summaries(self, partials: list[dict]) -> dict:
+        """Reduce step: merge per-section summaries into one document summary"""
+        prompt = f"""You are an expert content analyzer.
 
-Design a {game_type} game with the following structure:
-
-For MATCHING game:
-{{
-  "game_type": "matching",
-  "title": "creative title",
-  "theme_color": "CSS color based on subject (e.g., medical=#00bfa5, history=#ff6b35, tech=#667eea)",
-  "pairs": [
-    {{"term": "concept name", "definition": "clear definition"}},
-    ... (minimum 8 pairs)
-  ]
-}}
+These are summaries of consecutive sections of one document:
+{json.dumps(partials, separators=(',', ':'))}
 
-For QUIZ game:
-{{
-  "game_type": "quiz",
-  "title": "creative title",
-  "theme_color": "CSS color",
-  "questions": [
-    {{
-      "question": "question text",
-      "options": ["A", "B", "C", "D"],
-      "correct": 0,
-      "explanation": "why this is correct"
-    }},
-    ... (minimum 10 questions)
-  ]
-}}
+Merge them into a single summary of the whole document. Remove duplicates
+and keep the most important items (at least 10-15 key concepts).
 
-For FLASHCARDS game:
-{{
-  "game_type": "flashcards",
-  "title": "creative title",
-  "theme_color": "CSS color",
-  "cards": [
-    {{"front": "term or question", "back": "definition or answer"}},
-    ... (minimum 12 cards)
-  ]
-}}
+Provide a structured summary in JSON format with these keys:
+- topic: main subject
+- subject_area: (e.g., "biology", "history", "programming", "physics")
+- key_concepts: list of important terms/concepts
+- facts: list of key facts or relationships
+- learning_objectives: what students should learn
 
-Use content from the summary. Make it educational and engaging.
-Return ONLY valid JSON."""
+Return ONLY valid JSON, no markdown formatting."""
 
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.7
+        return await self._chat(
+            "extractor",
+            [{"role": "user", "content": prompt}],
+            temperature=0.3,
+            response_format=json_schema_format("Summary", SUMMARY_SCHEMA)
         )
+    
+    async def agent_2_architect(self, summary_str: str, game_type: str, status) -> dict:
+        """AI Agent 2: Design game logic structure"""
+        status.markdown('<div class="agent-status">🏗️ Agent 2 (Architect): Designing game structure...</div>', 
+                       unsafe_allow_html=True)
         
-        game_structure = self._extract_json(response.choices[0].message.content)
+        game_structure = await self._chat(
+            "architect",
+            self._messages(summary_str, ARCHITECT_INSTRUCTIONS, f"Design a {game_type} game."),
+            temperature=0.7,
+            response_format=json_schema_format("GameStructure", GAME_SCHEMAS[game_type])
+        )
         return game_structure
     
-    def agent_3_reviewer(self, game_structure: dict, original_summary: dict) -> tuple[bool, str]:
-        """AI Agent 3: Fact-check game content against original text"""
-        st.markdown('<div class="agent-status">🔍 Agent 3 (Reviewer): Fact-checking content...</div>', 
-                   unsafe_allow_html=True)
+    async def agent_2_architect_batch(self, summary_str: str, game_types: list[str], status) -> dict[str, dict]:
+        """AI Agent 2 (batched): Design several game types in a single request"""
+        status.markdown('<div class="agent-status">🏗️ Agent 2 (Architect): Designing all game structures...</div>', 
+                       unsafe_allow_html=True)
         
-        prompt = f"""You are a strict educational content reviewer.
-
-Original Content Summary:
-{json.dumps(original_summary, indent=2)}
-
-Proposed Game Structure:
-{json.dumps(game_structure, indent=2)}
+        # One response keyed by game type amortizes the shared summary prefix
+        batch_schema = {
+            "type": "object",
+            "properties": {game_type: GAME_SCHEMAS[game_type] for game_type in game_types},
+            "required": list(game_types),
+            "additionalProperties": False
+        }
+        
+        return await self._chat(
+            "architect",
+            self._messages(
+                summary_str,
+                ARCHITECT_INSTRUCTIONS,
+                f"Design one game of each type: {', '.join(game_types)}. "
+                "Return a JSON object keyed by game type."
+            ),
+            temperature=0.7,
+            response_format=json_schema_format("GameStructures", batch_schema)
+        )
+    
+    async def agent_3_reviewer(
+        self, game_structure: dict, summary_str: str, status, indices: list[int] | None = None
+    ) -> tuple[bool, str, list[int]]:
+        """AI Agent 3: Fact-check game content (or only the items at indices) against original text"""
+        status.markdown('<div class="agent-status">🔍 Agent 3 (Reviewer): Fact-checking content...</div>', 
+                       unsafe_allow_html=True)
+        
+        instructions = """You are a strict educational content reviewer.
 
-Review the game content for:
+Review the proposed game structure against the summary for:
 1. Factual accuracy (do terms/definitions match the source?)
 2. Completeness (are key concepts included?)
 3. Clarity (are explanations clear and correct?)
 
 Respond in JSON format:
-{{
+{
   "approved": true/false,
-  "feedback": "specific issues found or 'Content approved'"
-}}
+  "issue_code": "ok" | "missing_concepts" | "wrong_definition" | "duplicates" | "too_few_items",
+  "bad_terms": ["at most 3 offending terms, copied exactly"]
+}
 
 Be strict but fair. Approve only if content is accurate and educational.
-Return ONLY valid JSON."""
+Do not explain. Return ONLY valid JSON."""
 
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.2
+        if indices is None:
+            dynamic = f"Proposed Game Structure:\n{json.dumps(game_structure, separators=(',', ':'))}"
+        else:
+            # Only the patched items need another look; the rest were already reviewed
+            items = game_structure[GAME_ITEM_SCHEMAS[game_structure['game_type']][0]]
+            revised = {str(i): items[i] for i in indices}
+            dynamic = f"""Revised items of a {game_structure['game_type']} game, keyed by position.
+Review only these items; the rest of the game was already reviewed:
+{json.dumps(revised, separators=(',', ':'))}"""
+        
+        review = await self._chat(
+            "reviewer",
+            self._messages(summary_str, instructions, dynamic),
+            temperature=0.2,
+            max_tokens=128,
+            response_format=json_schema_format("Review", REVIEW_SCHEMA)
         )
         
-        review = self._extract_json(response.choices[0].message.content)
-        return review.get('approved', False), review.get('feedback', 'No feedback provided')
+        if not review:
+            # No usable verdict: nothing to refine, so the next attempt reviews again
+            return False, "Reviewer response was unusable", []
+        if review['approved']:
+            return True, 'Content approved', []
+        
+        # Turn the fixed-slot verdict into refiner instructions
+        feedback = ISSUE_GUIDANCE[review['issue_code']]
+        if review['bad_terms']:
+            feedback += f" Affected items: {', '.join(review['bad_terms'])}"
+        
+        bad_indices = self._bad_indices(game_structure, review['bad_terms'], review['issue_code'], indices)
+        return review['approved'], feedback, bad_indices
     
-    def agent_4_refiner(self, game_structure: dict, feedback: str, original_summary: dict) -> dict:
-        """AI Agent 4: Refine game based on reviewer feedback"""
-        st.markdown('<div class="agent-status">✨ Agent 4 (Refiner): Improving game based on feedback...</div>', 
-                   unsafe_allow_html=True)
+    async def agent_4_refiner(
+        self, game_structure: dict, bad_indices: list[int], feedback: str, summary_str: str, status
+    ) -> dict:
+        """AI Agent 4: Replace only the flagged items based on reviewer feedback"""
+        status.markdown('<div class="agent-status">✨ Agent 4 (Refiner): Improving game based on feedback...</div>', 
+                       unsafe_allow_html=True)
         
-        prompt = f"""You are a game content refiner.
+        game_type = game_structure['game_type']
+        items_key, item_schema = GAME_ITEM_SCHEMAS[game_type]
+        items = game_structure[items_key]
+        label = ITEM_LABEL_FIELDS[game_type]
+        
+        instructions = """You are a game content refiner.
 
-Original Summary:
-{json.dumps(original_summary, indent=2)}
+Replace only the game items at the listed positions; a null item is a new slot to fill.
+Fix the issues mentioned in the reviewer feedback and keep replacements distinct from the other items.
+Ensure all content is factually accurate and educationally sound.
+Return ONLY a JSON object {"items": [...]} with one replacement per position, in the order given."""
 
-Current Game Structure:
-{json.dumps(game_structure, indent=2)}
+        # Send the flagged items and the other items' labels, not the whole structure
+        current = {str(i): items[i] if i < len(items) else None for i in bad_indices}
+        others = [item[label] for i, item in enumerate(items) if i not in bad_indices]
+        dynamic = f"""Game type: {game_type}
+Positions to replace: {bad_indices}
 
-Reviewer Feedback:
-{feedback}
+Current items at those positions:
+{json.dumps(current, separators=(',', ':'))}
 
-Fix the issues mentioned in the feedback while maintaining the same JSON structure.
-Ensure all content is factually accurate and educationally sound.
-Return ONLY the corrected JSON in the same format."""
+Other items already in the game:
+{'; '.join(others)}
 
-        response = client.chat.completions.create(
-            model=self.model,
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.5
+Reviewer Feedback:
+{feedback}"""
+
+        patch_schema = {
+            "type": "object",
+            "properties": {"items": {"type": "array", "items": item_schema}},
+            "required": ["items"],
+            "additionalProperties": False
+        }
+        
+        patch = await self._chat(
+            "refiner",
+            self._messages(summary_str, instructions, dynamic),
+            temperature=0.5,
+            response_format=json_schema_format("ItemPatch", patch_schema)
         )
+        if not patch:
+            # Keep the current items; the flagged positions are reviewed and refined again
+            return game_structure
         
-        refined_structure = self._extract_json(response.choices[0].message.content)
-        return refined_structure
+        # Merge the replacements locally; positions past the end are appended
+        patched = list(items)
+        for i, new_item in zip(bad_indices, patch['items']):
+            if i < len(patched):
+                patched[i] = new_item
+            else:
+                patched.append(new_item)
+        
+        return {**game_structure, items_key: patched}
     
-    def agent_5_builder(self, game_structure: dict) -> str:
+    def agent_5_builder(self, game_structure: dict, status) -> str:
         """AI Agent 5: Generate final HTML game from template"""
-        st.markdown('<div class="agent-status">🎨 Agent 5 (Builder): Building game interface...</div>', 
-                   unsafe_allow_html=True)
+        status.markdown('<div class="agent-status">🎨 Agent 5 (Builder): Building game interface...</div>', 
+                       unsafe_allow_html=True)
         
         game_type = game_structure.get('game_type', 'matching')
         template_path = self.template_dir / f'{game_type}_game.html'
         
-        # Check if template exists
-        if not template_path.exists():
+        # Check if template was found at startup
+        if game_type not in self.templates:
             # Provide helpful error message
             available_templates = list(self.template_dir.glob('*.html'))
             error_msg = f"Template not found: {template_path}\n\n"
@@ -319,22 +728,198 @@ Return ONLY the corrected JSON in the same format."""
             
             raise FileNotFoundError(error_msg)
         
-        # Read and render template
-        with open(template_path, 'r', encoding='utf-8') as f:
-            template_content = f.read()
-        
-        template = Template(template_content)
-        html_output = template.render(**game_structure)
+        # Render the precompiled template
+        html_output = self.templates[game_type].render(**game_structure)
         
         return html_output
     
-    def _extract_json(self, text: str) -> dict:
-        """Extract JSON from AI response (handles markdown code blocks)"""
-        # Remove markdown code blocks
-        text = re.sub(r'```json\s*', '', text)
-        text = re.sub(r'```\s*', '', text)
-        text = text.strip()
+    async def _local_review(self, game_structure: dict, summary: dict) -> tuple[bool, str, list[int]]:
+        """Deterministic review of term-based games against the summary (no API call)"""
+        game_type = game_structure.get('game_type')
+        if game_type not in TERM_FIELDS:
+            return False, "No local checks for this game type", []
+        
+        items = game_structure.get(GAME_ITEM_SCHEMAS[game_type][0], [])
+        terms = [item[TERM_FIELDS[game_type]].strip().lower() for item in items]
+        issues = []
+        
+        # 1. Every term must be backed by the extracted concepts or facts
+        source = ' '.join(
+            str(entry) for entry in summary.get('key_concepts', []) + summary.get('facts', [])
+        ).lower()
+        candidates = [i for i, term in enumerate(terms) if term not in source]
+        if candidates and self._concepts_emb is not None:
+            # One embeddings call and one matrix product score every term against every concept
+            scores = await self._embed([terms[i] for i in candidates]) @ self._concepts_emb.T
+            unsupported = [
+                i for i, best in zip(candidates, scores.max(axis=1))
+                if best < EMBEDDING_MATCH_THRESHOLD
+            ]
+        else:
+            unsupported = candidates
+        if unsupported:
+            issues.append(f"Terms not found in source: {', '.join(terms[i] for i in unsupported)}")
+        
+        # 2. No duplicate terms (later copies are the ones to replace)
+        duplicates = [i for i, term in enumerate(terms) if term in terms[:i]]
+        if duplicates:
+            issues.append(f"Duplicate terms: {', '.join(sorted({terms[i] for i in duplicates}))}")
+        
+        # 3. Minimum item count (missing slots are appended)
+        missing = list(range(len(items), MIN_ITEMS[game_type]))
+        if missing:
+            issues.append(f"Only {len(items)} items, need at least {MIN_ITEMS[game_type]}")
+        
+        if issues:
+            return False, '; '.join(issues), sorted(set(unsupported + duplicates + missing))
+        return True, 'Content approved by local checks', []
+    
+    async def _embed(self, texts: list[str]) -> np.ndarray:
+        """Embed texts in a single request; rows are L2-normalized"""
+        response = await client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+        vectors = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    
+    async def _concept_embeddings(self, summary: dict) -> np.ndarray | None:
+        """Key concept embeddings, cached next to the PDF's summary"""
+        cache_path = SUMMARY_CACHE_DIR / f"{self._pdf_digest}.npy"
+        if cache_path.exists():
+            try:
+                return np.load(cache_path)
+            except (OSError, ValueError, EOFError):
+                pass  # Unreadable entry: recompute and overwrite it
+        
+        concepts = [str(concept) for concept in summary.get('key_concepts', []) if str(concept).strip()]
+        if not concepts:
+            return None
+        
+        embeddings = await self._embed(concepts)
+        buffer = io.BytesIO()
+        np.save(buffer, embeddings)
+        write_atomic(cache_path, buffer.getvalue())
+        return embeddings
+    
+    def _bad_indices(
+        self, game_structure: dict, bad_terms: list[str], issue_code: str, indices: list[int] | None
+    ) -> list[int]:
+        """Map reviewer-flagged terms to item positions for the refiner"""
+        game_type = game_structure['game_type']
+        items = game_structure[GAME_ITEM_SCHEMAS[game_type][0]]
+        label = ITEM_LABEL_FIELDS[game_type]
+        candidates = list(range(len(items))) if indices is None else indices
         
+        labels = {i: items[i][label].strip().casefold() for i in candidates}
+        bad, unmatched = set(), 0
+        for term in bad_terms:
+            term = term.strip().casefold()
+            # Exact label first; otherwise a label containing the term, or a term containing
+            # a label long enough not to match by accident ("ph" inside "phosphate")
+            match = next((i for i in candidates if term and labels[i] == term), None)
+            if match is None:
+                match = next(
+                    (
+                        i for i in candidates
+                        if term and (term in labels[i] or (len(labels[i]) >= MIN_LABEL_MATCH_LEN and labels[i] in term))
+                    ),
+                    None
+                )
+            if match is None:
+                unmatched += 1
+            else:
+                bad.add(match)
+        
+        if issue_code in ('missing_concepts', 'too_few_items'):
+            # Unmatched terms and missing slots become new items
+            new_slots = max(unmatched, MIN_ITEMS[game_type] - len(items) if issue_code == 'too_few_items' else 0)
+            bad.update(range(len(items), len(items) + new_slots))
+        elif unmatched:
+            # A flagged term we cannot locate: redo everything that was reviewed
+            return list(candidates)
+        
+        # Nothing specific flagged: fall back to everything that was reviewed
+        return sorted(bad) or list(candidates)
+    
+    def _compress_for_prompt(self, summary: dict) -> str:
+        """Rule-based compression of the summary for downstream prompts"""
+        lines = []
+        for key, value in summary.items():
+            # Agents 2-4 only need the distilled summary, not the raw document
+            if key == 'full_markdown':
+                continue
+            
+            if isinstance(value, list):
+                text = '; '.join(str(item) for item in value)
+            else:
+                text = str(value)
+            
+            text = POLITE_RE.sub(' ', text)
+            if key != 'key_concepts':
+                # Concepts are the terms games are built and checked against: keep them verbatim
+                text = FILLER_RE.sub(' ', text)
+            text = WHITESPACE_RE.sub(' ', text).strip()
+            lines.append(f"{SUMMARY_KEY_ALIASES.get(key, key)}: {text}")
+        
+        return '\n'.join(lines)
+    
+    def _messages(self, summary_str: str, instructions: str, dynamic: str) -> list[dict]:
+        """Build a message list whose leading bytes are shared by agents 2-4"""
+        # Invariant content first so OpenAI's automatic prefix cache can hit
+        return [
+            {"role": "system", "content": PIPELINE_PREAMBLE},
+            {"role": "system", "content": f"SUMMARY:\n{summary_str}"},
+            {"role": "system", "content": instructions},
+            {"role": "user", "content": dynamic}
+        ]
+    
+    async def _chat(self, role: str, messages: list[dict], **kwargs) -> dict:
+        """Stream a structured-output completion for an agent role and return the parsed JSON
+
+        Returns {} (after reporting why) for refusals, truncated output or unparsable
+        JSON, so callers can retry instead of aborting every game type.
+        """
+        if self._summary_cache_key:
+            kwargs['prompt_cache_key'] = self._summary_cache_key
+        
+        stream = await client.chat.completions.create(
+            model=self.models[role],
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **kwargs
+        )
+        
+        # Read to the end: the usage chunk arrives after the last content chunk
+        parts = []
+        refusal = []
+        finish_reason = None
+        async for chunk in stream:
+            # Track how much of the prompt was served from the cache (final chunk)
+            usage = chunk.usage
+            if usage:
+                self.prompt_tokens += usage.prompt_tokens
+                details = usage.prompt_tokens_details
+                if details and details.cached_tokens:
+                    self.cached_tokens += details.cached_tokens
+            
+            if not chunk.choices:
+                continue
+            
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if choice.delta.refusal:
+                refusal.append(choice.delta.refusal)
+            if choice.delta.content:
+                parts.append(choice.delta.content)
+        
+        if refusal:
+            st.warning(f"⚠️ {role.title()} declined to answer: {''.join(refusal)}")
+            return {}
+        if finish_reason == 'length':
+            st.warning(f"⚠️ {role.title()} response was cut off at the token limit")
+            return {}
+        
+        text = ''.join(parts)
         try:
             return json.loads(text)
         except json.JSONDecodeError as e:
@@ -342,61 +927,138 @@ Return ONLY the corrected JSON in the same format."""
             st.code(text)
             return {}
     
-    def run_diamond_workflow(self, pdf_path: str, game_type: str) -> str:
-        """Execute the complete diamond workflow with retry loop"""
-        
-        # Agent 1: Extract and summarize
-        summary = self.agent_1_extractor(pdf_path)
-        if not summary:
-            raise ValueError("Failed to extract PDF content")
-        
-        # Diamond loop: Architect → Reviewer → (Refiner) → repeat until approved
+    async def _diamond_loop(
+        self, summary: dict, summary_str: str, game_type: str, game_structure: dict, status
+    ) -> dict:
+        """Reviewer → (Refiner) → repeat until the architect's draft is approved"""
         attempt = 0
-        game_structure = None
         feedback = ""
+        bad_indices = []
+        review_indices = None  # None reviews the whole structure
+        reviewer_rejected = False
         
         while attempt < self.max_retries:
             attempt += 1
-            st.info(f"🔄 Attempt {attempt}/{self.max_retries}")
+            st.info(f"🔄 [{game_type}] Attempt {attempt}/{self.max_retries}")
             
-            # Agent 2: Design game structure
-            if attempt == 1:
-                game_structure = self.agent_2_architect(summary, game_type)
-            else:
-                # Agent 4: Refine based on previous feedback
-                game_structure = self.agent_4_refiner(game_structure, feedback, summary)
+            if attempt > 1:
+                if not game_structure:
+                    # Agent 2: The previous design was unusable, start over
+                    game_structure = await self.agent_2_architect(summary_str, game_type, status)
+                    review_indices = None
+                    reviewer_rejected = False
+                elif bad_indices:
+                    # Agent 4: Patch only the flagged items
+                    game_structure = await self.agent_4_refiner(
+                        game_structure, bad_indices, feedback, summary_str, status
+                    )
+                    items = game_structure[GAME_ITEM_SCHEMAS[game_type][0]]
+                    review_indices = [i for i in bad_indices if i < len(items)]
+                # Otherwise the last verdict was unusable: review the same items again
             
             if not game_structure:
-                st.warning(f"Attempt {attempt} failed to generate structure")
+                st.warning(f"[{game_type}] Attempt {attempt} failed to generate structure")
                 continue
             
-            # Agent 3: Review
-            approved, feedback = self.agent_3_reviewer(game_structure, summary)
+            # Local checks first on a fresh draft; Agent 3 only reviews what they cannot
+            # approve. Once Agent 3 has rejected a version, only it can judge the fix (the
+            # local checks never look at definitions or answers).
+            approved, local_indices = False, []
+            if not reviewer_rejected:
+                approved, feedback, local_indices = await self._local_review(game_structure, summary)
+                if not approved and game_type in TERM_FIELDS:
+                    st.caption(f"🧮 [{game_type}] Local check: {feedback}")
+            
+            if not approved:
+                # Agent 3: Review; positions the local checks flagged are refined too
+                approved, feedback, bad_indices = await self.agent_3_reviewer(
+                    game_structure, summary_str, status, review_indices
+                )
+                if not approved:
+                    bad_indices = sorted(set(bad_indices) | set(local_indices))
+                reviewer_rejected = not approved
             
             if approved:
-                st.success(f"✅ Content approved on attempt {attempt}!")
+                st.success(f"✅ [{game_type}] Content approved on attempt {attempt}!")
                 break
             else:
-                st.warning(f"⚠️ Reviewer feedback (attempt {attempt}): {feedback}")
+                st.warning(f"⚠️ [{game_type}] Reviewer feedback (attempt {attempt}): {feedback}")
                 if attempt == self.max_retries:
-                    st.error("Max retries reached. Proceeding with best version...")
+                    st.error(f"[{game_type}] Max retries reached. Proceeding with best version...")
+        
+        return game_structure
+    
+    async def run_diamond_workflow(self, pdf_bytes: bytes, game_type: str) -> str:
+        """Execute the complete diamond workflow with retry loop"""
+        games = await self.run_multi_workflow(pdf_bytes, [game_type])
+        return games[game_type]
+    
+    async def run_multi_workflow(self, pdf_bytes: bytes, game_types: list[str]) -> dict[str, str]:
+        """Extract once, then run one diamond loop per game type concurrently"""
+        
+        # One status line updated in place, plus one per concurrent diamond loop
+        status = st.empty()
+        loop_status = {game_type: st.empty() for game_type in game_types}
         
-        # Agent 5: Build final game
-        html_game = self.agent_5_builder(game_structure)
+        # The factory outlives a PDF: don't send Agent 1's calls under the previous summary's key
+        self._summary_cache_key = None
         
-        return html_game
+        # Agent 1: Extract and summarize
+        summary = await self.extract_and_summarize(pdf_bytes, status)
+        if not summary:
+            raise ValueError("Failed to extract PDF content")
+        
+        # Embed key concepts once for the local reviewer (term-based games only)
+        if any(game_type in TERM_FIELDS for game_type in game_types):
+            self._concepts_emb = await self._concept_embeddings(summary)
+        
+        # Compress the summary once so every downstream prompt shares the same prefix bytes
+        summary_str = self._compress_for_prompt(summary)
+        self._summary_cache_key = hashlib.sha256(summary_str.encode('utf-8')).hexdigest()
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        
+        # Agent 2: Design game structures (one request covers every selected type)
+        if len(game_types) == 1:
+            drafts = {game_types[0]: await self.agent_2_architect(summary_str, game_types[0], status)}
+        else:
+            drafts = await self.agent_2_architect_batch(summary_str, game_types, status)
+        
+        # Diamond loops are independent per game type, so their API calls overlap
+        structures = await asyncio.gather(
+            *(
+                self._diamond_loop(summary, summary_str, game_type, drafts.get(game_type, {}), loop_status[game_type])
+                for game_type in game_types
+            )
+        )
+        
+        if self.prompt_tokens:
+            st.caption(f"🧊 Prompt cache: {self.cached_tokens}/{self.prompt_tokens} input tokens served from cache")
+        
+        # Agent 5: Build final games (skipping types that never produced a usable design)
+        games = {}
+        for game_type, game_structure in zip(game_types, structures):
+            if game_structure:
+                games[game_type] = self.agent_5_builder(game_structure, loop_status[game_type])
+            else:
+                st.error(f"❌ [{game_type}] No usable game structure after {self.max_retries} attempts")
+        
+        if not games:
+            raise ValueError("Failed to generate any game")
+        return games
 
 
 def main():
     """Main Streamlit application"""
     
+    inject_css()
+    
     # Sidebar
     with st.sidebar:
         st.title("⚙️ Configuration")
         
         # API Key status
-        api_key = os.getenv("OPENAI_API_KEY")
-        if api_key:
+        if OPENAI_API_KEY:
             st.success("✅ OpenAI API Key loaded")
         else:
             st.error("❌ No API key found in .env file")
@@ -406,9 +1068,10 @@ def main():
         st.divider()
         
         # Game type selector
-        game_type = st.selectbox(
-            "🎮 Select Game Type",
-            ["matching", "quiz", "flashcards"],
+        game_types = st.multiselect(
+            "🎮 Select Game Types",
+            GAME_TYPES,
+            default=["matching"],
             format_func=lambda x: {
                 "matching": "🔗 Matching Game",
                 "quiz": "❓ Quiz Game",
@@ -416,6 +1079,12 @@ def main():
             }[x]
         )
         
+        # Cost mode
+        aggressive_cost_mode = st.toggle(
+            "💸 Aggressive cost mode",
+            help="Run every agent on gpt-4o-mini (cheaper and faster, less creative)"
+        )
+        
         st.divider()
         
         st.markdown("""
@@ -439,63 +1108,77 @@ def main():
     )
     
     if uploaded_file:
-        # Save uploaded file temporarily
-        temp_path = f"temp_{uploaded_file.name}"
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        pdf_bytes = uploaded_file.getvalue()
+        
+        # New upload: start PDF parsing while the user picks options
+        if st.session_state.get("markdown_file_id") != uploaded_file.file_id:
+            st.session_state["markdown_file_id"] = uploaded_file.file_id
+            st.session_state.pop("games", None)
+            st.session_state["markdown_future"] = get_pdf_executor().submit(
+                pdf_to_markdown, pdf_bytes
+            )
         
         st.success(f"✅ Uploaded: {uploaded_file.name}")
         
+        if not game_types:
+            st.warning("Select at least one game type in the sidebar")
+        
         # Generate button
-        if st.button("🚀 Generate Game", type="primary"):
+        if st.button("🚀 Generate Game", type="primary", disabled=not game_types):
+            st.session_state.pop("games", None)
             try:
-                factory = PDFGameFactory()
+                # One factory per session; templates are located and compiled only once
+                if "factory" not in st.session_state:
+                    st.session_state.factory = PDFGameFactory()
+                factory = st.session_state.factory
+                factory.set_cost_mode(aggressive_cost_mode)
                 
                 with st.spinner("🔮 Running multi-agent workflow..."):
-                    html_game = factory.run_diamond_workflow(temp_path, game_type)
+                    games = asyncio.run(
+                        factory.run_multi_workflow(pdf_bytes, game_types)
+                    )
                 
-                # Save game
-                output_path = f"game_{game_type}_{uploaded_file.name.replace('.pdf', '')}.html"
-                with open(output_path, 'w', encoding='utf-8') as f:
-                    f.write(html_game)
+                # Save games
+                for game_type, html_game in games.items():
+                    output_path = f"game_{game_type}_{uploaded_file.name.replace('.pdf', '')}.html"
+                    with open(output_path, 'w', encoding='utf-8') as f:
+                        f.write(html_game)
                 
-                # Success message
-                st.markdown(f"""
-                <div class="success-box">
-                    <h2>🎉 Game Generated Successfully!</h2>
-                    <p>Your {game_type} game is ready to play.</p>
-                </div>
-                """, unsafe_allow_html=True)
+                # Download clicks rerun the script: keep the games so every button survives
+                st.session_state["games"] = games
                 
+            except Exception as e:
+                st.error(f"❌ Error: {str(e)}")
+                import traceback
+                st.code(traceback.format_exc())
+        
+        games = st.session_state.get("games")
+        if games:
+            # Success message
+            st.markdown(f"""
+            <div class="success-box">
+                <h2>🎉 Game Generated Successfully!</h2>
+                <p>Your {', '.join(games)} game{'s are' if len(games) > 1 else ' is'} ready to play.</p>
+            </div>
+            """, unsafe_allow_html=True)
+            
+            for game_type, html_game in games.items():
                 # Download button
                 st.download_button(
-                    label="⬇️ Download Game (HTML)",
+                    label=f"⬇️ Download {game_type.title()} Game (HTML)",
                     data=html_game,
-                    file_name=output_path,
-                    mime="text/html"
+                    file_name=f"game_{game_type}_{uploaded_file.name.replace('.pdf', '')}.html",
+                    mime="text/html",
+                    key=f"download_{game_type}"
                 )
                 
                 # Preview
-                with st.expander("👀 Preview Game", expanded=True):
+                with st.expander(f"👀 Preview {game_type.title()} Game", expanded=len(games) == 1):
                     st.components.v1.html(html_game, height=800, scrolling=True)
-                
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
-                import traceback
-                st.code(traceback.format_exc())
-            
-            finally:
-                # Cleanup
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
     
     # Footer
     st.divider()
-    st.markdown("""
-    <div style='text-align: center; color: #00f5ff; font-family: monospace;'>
-        Built with 🧠 AI Agents | Powered by GPT-4o & Streamlit
-    </div>
-    """, unsafe_allow_html=True)
+    render_footer()
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@ import os
 import sys
 from pathlib import Path
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 def print_banner():
     """Print welcome banner"""
@@ -38,6 +39,16 @@ def create_templates_directory():
     print(f"✅ Created templates directory: {templates_dir.absolute()}")
     return templates_dir
 
+def link_or_move(src, dest):
+    """Place src at dest without copying data: hardlink, then rename, then copy"""
+    try:
+        os.link(src, dest)
+    except OSError:
+        try:
+            os.rename(src, dest)
+        except OSError:
+            shutil.copy(src, dest)
+
 def find_and_move_templates():
     """Find template HTML files and move them to templates/ directory"""
     templates_dir = Path('templates')
@@ -56,7 +67,7 @@ def find_and_move_templates():
             print(f"✅ Template already in place: {template_file}")
             found_files.append(template_file)
         elif src.exists():
-            shutil.copy(src, dest)
+            link_or_move(src, dest)
             print(f"✅ Moved template: {template_file} → templates/")
             moved_files.append(template_file)
         else:
@@ -101,11 +112,13 @@ def check_requirements():
         print("   Creating requirements.txt...")
         
         requirements = """streamlit>=1.31.0
-openai>=1.12.0
+openai>=1.99.0
 python-dotenv>=1.0.0
 jinja2>=3.1.0
 PyMuPDF>=1.24.0
 pymupdf4llm>=0.0.10
+tiktoken>=0.7.0
+numpy>=1.24.0
 """
         with open('requirements.txt', 'w') as f:
             f.write(requirements)
@@ -116,6 +129,14 @@ pymupdf4llm>=0.0.10
     print("✅ requirements.txt found")
     return True
 
+def _try_import(package):
+    """Import a package, returning (package, ImportError or None)"""
+    try:
+        __import__(package)
+        return package, None
+    except ImportError as e:
+        return package, e
+
 def check_dependencies():
     """Check if required packages are installed"""
     required_packages = [
@@ -123,19 +144,22 @@ def check_dependencies():
         'openai',
         'dotenv',
         'jinja2',
-        'pymupdf4llm'
+        'pymupdf',
+        'pymupdf4llm',
+        'tiktoken',
+        'numpy'
     ]
     
     missing_packages = []
     
-    for package in required_packages:
-        try:
-            if package == 'dotenv':
-                __import__('dotenv')
-            else:
-                __import__(package)
+    # Imports are independent and mostly disk-bound, so run them concurrently
+    with ThreadPoolExecutor(max_workers=len(required_packages)) as executor:
+        results = list(executor.map(_try_import, required_packages))
+    
+    for package, error in results:
+        if error is None:
             print(f"✅ Package installed: {package}")
-        except ImportError:
+        else:
             print(f"❌ Package missing: {package}")
             missing_packages.append(package)
     